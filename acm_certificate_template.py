@@ -1,54 +1,147 @@
-import os
-from dotenv import load_dotenv
-from troposphere import Template, Ref, Output, Export, certificatemanager
-
-# Load environment variables from .env
-load_dotenv()
-domain_name = os.getenv("DOMAIN_NAME")
-hosted_zone_id = os.getenv("HOSTED_ZONE_ID")
-
-# Sanitize domain name
-sanitized_domain = domain_name.replace(".", "-").replace("/", "-")
-
-# Initialize the CloudFormation template
-template = Template()
-template.set_description("CloudFormation stack to generate ACM Certificate.")
-
-# Define the SSL certificate for CloudFront using ACM
-certificate = template.add_resource(
-    certificatemanager.Certificate(
-        "PortfolioCertificate",
-        DomainName=domain_name,
-        SubjectAlternativeNames=[f"www.{domain_name}"],
-        ValidationMethod="DNS",
-        DomainValidationOptions=[
-            certificatemanager.DomainValidationOption(
-                DomainName=domain_name,
-                HostedZoneId=hosted_zone_id,
-            ),
-            certificatemanager.DomainValidationOption(
-                DomainName=f"www.{domain_name}",
-                HostedZoneId=hosted_zone_id,
-            ),
-        ],
-    )
+import sys
+import argparse
+from env_cache import require_env
+from template_output import (
+    template_key,
+    dry_run,
+    is_up_to_date,
+    write_stamp,
+    write_template,
 )
 
-# Output the Certificate ARN for cross-stack reference
-template.add_output(
-    Output(
-        "CertificateArn",
-        Value=Ref(certificate),
-        Export=Export(
-            f"PortfolioCertificateARN-{sanitized_domain}"
-        ),  # Name for cross-stack export
+# Table for sanitizing domain names in a single pass
+SANITIZE_TABLE = str.maketrans({".": "-", "/": "-"})
+
+
+# Build the ACM certificate template for the given domain as a plain dict
+def build_template(domain_name, hosted_zone_id):
+    sanitized_domain = domain_name.translate(SANITIZE_TABLE)
+
+    return {
+        "Description": "CloudFormation stack to generate ACM Certificate.",
+        "Resources": {
+            # Define the SSL certificate for CloudFront using ACM
+            "PortfolioCertificate": {
+                "Type": "AWS::CertificateManager::Certificate",
+                "Properties": {
+                    "DomainName": domain_name,
+                    "SubjectAlternativeNames": [f"www.{domain_name}"],
+                    "ValidationMethod": "DNS",
+                    "DomainValidationOptions": [
+                        {
+                            "DomainName": domain_name,
+                            "HostedZoneId": hosted_zone_id,
+                        },
+                        {
+                            "DomainName": f"www.{domain_name}",
+                            "HostedZoneId": hosted_zone_id,
+                        },
+                    ],
+                },
+            },
+        },
+        "Outputs": {
+            # Output the Certificate ARN for cross-stack reference
+            "CertificateArn": {
+                "Value": {"Ref": "PortfolioCertificate"},
+                "Export": {
+                    "Name": f"PortfolioCertificateARN-{sanitized_domain}"
+                },  # Name for cross-stack export
+            },
+        },
+    }
+
+
+# Build the same template with troposphere to validate it against the resource schema
+def build_troposphere_template(domain_name, hosted_zone_id):
+    from troposphere import Template, Ref, Output, Export, certificatemanager
+
+    sanitized_domain = domain_name.translate(SANITIZE_TABLE)
+
+    # Initialize the CloudFormation template
+    template = Template()
+    template.set_description("CloudFormation stack to generate ACM Certificate.")
+
+    # Define the SSL certificate for CloudFront using ACM
+    certificate = template.add_resource(
+        certificatemanager.Certificate(
+            "PortfolioCertificate",
+            DomainName=domain_name,
+            SubjectAlternativeNames=[f"www.{domain_name}"],
+            ValidationMethod="DNS",
+            DomainValidationOptions=[
+                certificatemanager.DomainValidationOption(
+                    DomainName=domain_name,
+                    HostedZoneId=hosted_zone_id,
+                ),
+                certificatemanager.DomainValidationOption(
+                    DomainName=f"www.{domain_name}",
+                    HostedZoneId=hosted_zone_id,
+                ),
+            ],
+        )
     )
-)
 
-# Write the template to a YAML file
-with open(f"acm-certificate-stack-{sanitized_domain}.yaml", "w") as f:
-    f.write(template.to_yaml())
+    # Output the Certificate ARN for cross-stack reference
+    template.add_output(
+        Output(
+            "CertificateArn",
+            Value=Ref(certificate),
+            Export=Export(
+                f"PortfolioCertificateARN-{sanitized_domain}"
+            ),  # Name for cross-stack export
+        )
+    )
 
-print(
-    f"Generated CloudFormation template: acm-certificate-stack-{sanitized_domain}.yaml"
-)
+    return template
+
+
+# Generate the ACM certificate template from the values in .env
+def main():
+    # Parse command-line arguments for --validate argument
+    parser = argparse.ArgumentParser(
+        description="Generate the ACM certificate CloudFormation template.",
+    )
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="Also build the template with troposphere and check that both match",
+    )
+    args = parser.parse_args()
+
+    # Load environment variables from .env, stopping early if any are missing or empty
+    domain_name, hosted_zone_id = require_env("DOMAIN_NAME", "HOSTED_ZONE_ID")
+
+    template = build_template(domain_name, hosted_zone_id)
+
+    # Check the plain template against troposphere's schema-validated output
+    if args.validate or dry_run():
+        validated = build_troposphere_template(domain_name, hosted_zone_id)
+        if validated.to_dict() != template:
+            sys.exit("Error: ACM template does not match the troposphere template.")
+        print("ACM template matches the troposphere template.")
+
+    # Stop before writing anything when DRY_RUN is set
+    if dry_run():
+        print("Dry run: ACM certificate template is valid.")
+        return
+
+    # Output file for the generated template
+    sanitized_domain = domain_name.translate(SANITIZE_TABLE)
+    output_file = f"acm-certificate-stack-{sanitized_domain}.json"
+
+    # Skip regeneration if the inputs haven't changed since the last run
+    stamp_key = template_key(__file__, domain_name, hosted_zone_id)
+    if is_up_to_date(output_file, stamp_key):
+        print(f"CloudFormation template is up to date: {output_file}")
+        return
+
+    # Write the template to a JSON file
+    write_template(template, output_file)
+    write_stamp(output_file, stamp_key)
+
+    print(f"Generated CloudFormation template: {output_file}")
+
+
+if __name__ == "__main__":
+    main()
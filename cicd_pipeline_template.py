@@ -1,57 +1,144 @@
-import os
-from dotenv import load_dotenv
-from troposphere import (
-    Template,
-    Ref,
-    Join,
-    GetAtt,
-    Parameter,
-    iam,
-    codebuild,
-    codepipeline,
-    s3,
+from env_cache import require_env
+from template_output import (
+    template_key,
+    dry_run,
+    is_up_to_date,
+    write_stamp,
+    write_template,
 )
 
-# Load environment variables from .env
-load_dotenv()
-domain_name = os.getenv("DOMAIN_NAME")
-github_user_name = os.getenv("GITHUB_USER_NAME")
-github_repo_name = os.getenv("GITHUB_REPO_NAME")
-github_app_connection_arn = os.getenv("GITHUB_APP_CONNECTION_ARN")
+# Table for sanitizing domain names in a single pass
+SANITIZE_TABLE = str.maketrans({".": "-", "/": "-"})
 
-# Sanitize domain name
-sanitized_domain = domain_name.replace(".", "-").replace("/", "-")
-
-# Initialize the CloudFormation template
-template = Template()
-template.set_description(
-    "CloudFormation stack for creating CI/CD pipeline with CodeBuild and CodePipeline."
+# IAM policy actions shared across template builds
+LOGS_ACTIONS = (
+    "logs:CreateLogGroup",
+    "logs:CreateLogStream",
+    "logs:PutLogEvents",
+)
+INVALIDATION_ACTIONS = ("cloudfront:CreateInvalidation",)
+CODEBUILD_S3_ACTIONS = (
+    "s3:GetObject",
+    "s3:PutObject",
+    "s3:DeleteObject",
+    "s3:ListBucket",
+    "s3:GetBucketLocation",
+)
+CODEPIPELINE_S3_ACTIONS = (
+    "s3:GetObject",
+    "s3:PutObject",
+    "s3:PutObjectAcl",
+    "s3:PutObjectVersionAcl",
+    "s3:GetBucketLocation",
+    "s3:ListBucket",
 )
+BUILD_ACTIONS = (
+    "codestar-connections:UseConnection",
+    "codebuild:BatchGetBuilds",
+    "codebuild:StartBuild",
+    "codebuild:StopBuild",
+    "codebuild:ListBuilds",
+)
+
+# Define buildspec file (configured for next.js), kept at minimal indentation
+BUILDSPEC = """\
+version: 0.2
+phases:
+  install:
+    commands:
+      - echo "Installing dependencies"
+      - npm install
+  pre_build:
+    commands:
+      - echo "Checking for .env file"
+      - if [ -f .env ]; then export $(cat .env | xargs); else echo ".env file not found. Skipping."; fi
+      - echo "Checking for .env.local file"
+      - if [ -f .env.local ]; then export $(cat .env.local | xargs); else echo ".env.local file not found. Skipping."; fi
+  build:
+    commands:
+      - echo "Creating production build"
+      - npm run build
+  post_build:
+    commands:
+      - echo "Syncing build artifacts with S3"
+      - aws s3 sync ./out s3://$ROOT_BUCKET_NAME --delete
+      - echo "Invalidating CloudFront cache"
+      - aws cloudfront create-invalidation --distribution-id $DISTRIBUTION_ID --paths "/*"
+artifacts:
+  files:
+    - "**/*"
+  base-directory: out
+cache:
+  paths:
+    - "node_modules/**/*" # Cache `node_modules` for faster `yarn` or `npm i`
+    - ".next/cache/**/*" # Cache Next.js for faster application rebuilds
+"""
+
+
+# Build the CI/CD pipeline template for the given domain and GitHub repo
+def build_template(
+    domain_name, github_user_name, github_repo_name, github_app_connection_arn
+):
+    # Import troposphere here so up-to-date runs skip loading it entirely
+    from troposphere import (
+        Template,
+        Ref,
+        Sub,
+        GetAtt,
+        Parameter,
+        iam,
+        codebuild,
+        codepipeline,
+        s3,
+    )
+
+    sanitized_domain = domain_name.translate(SANITIZE_TABLE)
+
+    # GitHub repository identifiers used by CodeBuild and CodePipeline
+    repo_id = f"{github_user_name}/{github_repo_name}"
+    repo_url = f"https://github.com/{repo_id}"
+
+    # Initialize the CloudFormation template
+    template = Template()
+    template.set_description(
+        "CloudFormation stack for creating CI/CD pipeline with CodeBuild and CodePipeline."
+    )
 
-# Retrieve the 'root' CloudFront Distribution ID
-distribution_id_param = template.add_parameter(
-    Parameter(
+    # Retrieve the 'root' CloudFront Distribution ID
+    distribution_id_param = Parameter(
         "DistributionId",
         Type="String",
         Description="The Distribution ID of the 'root' CloudFront distribution.",
     )
-)
 
-# Retrieve the 'root' S3 Bucket name
-root_bucket_name_param = template.add_parameter(
-    Parameter(
+    # Retrieve the 'root' S3 Bucket name
+    root_bucket_name_param = Parameter(
         "RootBucketName",
         Type="String",
         Description="The name of the 'root' S3 Bucket.",
     )
-)
 
-# Define the S3 bucket for CodePipeline artifacts
-artifact_bucket = template.add_resource(s3.Bucket("PipelineArtifactBucket"))
+    # Define the S3 bucket for CodePipeline artifacts
+    artifact_bucket = s3.Bucket("PipelineArtifactBucket")
 
-# Define IAM Role for CodeBuild with necessary permissions for CloudFront invalidations
-codebuild_role = template.add_resource(
-    iam.Role(
+    # S3 ARNs shared by the CodeBuild and CodePipeline role policies
+    s3_resource_arns = [
+        Sub(
+            "arn:aws:s3:::${BucketName}", {"BucketName": Ref(artifact_bucket)}
+        ),  # artifact S3 bucket
+        Sub(
+            "arn:aws:s3:::${BucketName}/*", {"BucketName": Ref(artifact_bucket)}
+        ),  # objects in artifact S3 bucket
+        Sub(
+            "arn:aws:s3:::${BucketName}", {"BucketName": Ref(root_bucket_name_param)}
+        ),  # 'root' S3 bucket
+        Sub(
+            "arn:aws:s3:::${BucketName}/*", {"BucketName": Ref(root_bucket_name_param)}
+        ),  # objects in 'root' S3 bucket
+    ]
+
+    # Define IAM Role for CodeBuild with necessary permissions for CloudFront invalidations
+    codebuild_role = iam.Role(
         "CodeBuildServiceRole",
         AssumeRolePolicyDocument={
             "Version": "2012-10-17",
@@ -75,79 +162,31 @@ codebuild_role = template.add_resource(
                     "Statement": [
                         {
                             "Effect": "Allow",
-                            "Action": [
-                                "logs:CreateLogGroup",
-                                "logs:CreateLogStream",
-                                "logs:PutLogEvents",
-                            ],
+                            "Action": LOGS_ACTIONS,
                             "Resource": [
-                                Join(
-                                    "",
-                                    [
-                                        "arn:aws:logs:",
-                                        Ref("AWS::Region"),
-                                        ":",
-                                        Ref("AWS::AccountId"),
-                                        ":log-group:/aws/codebuild/Build-GitHubPortfolio*",
-                                    ],
+                                Sub(
+                                    "arn:aws:logs:${AWS::Region}:${AWS::AccountId}:log-group:/aws/codebuild/Build-GitHubPortfolio*"
                                 ),  # CloudWatch Logs for CodeBuild
                             ],
                         },
                         {
                             "Effect": "Allow",
-                            "Action": [
-                                "cloudfront:CreateInvalidation",
-                            ],
+                            "Action": INVALIDATION_ACTIONS,
                             "Resource": [
-                                Join(
-                                    "",
-                                    [
-                                        "arn:aws:cloudfront::",
-                                        Ref("AWS::AccountId"),
-                                        ":distribution/",
-                                        Ref(distribution_id_param),
-                                    ],
+                                Sub(
+                                    "arn:aws:cloudfront::${AWS::AccountId}:distribution/${DistributionId}",
+                                    {"DistributionId": Ref(distribution_id_param)},
                                 ),  # 'root' CloudFront distribution ARN for invalidations
                             ],
                         },
                         {
                             "Effect": "Allow",
-                            "Action": [
-                                "s3:GetObject",
-                                "s3:PutObject",
-                                "s3:DeleteObject",
-                                "s3:ListBucket",
-                                "s3:GetBucketLocation",
-                            ],
-                            "Resource": [
-                                Join(
-                                    "", ["arn:aws:s3:::", Ref(artifact_bucket)]
-                                ),  # artifact S3 bucket
-                                Join(
-                                    "", ["arn:aws:s3:::", Ref(artifact_bucket), "/*"]
-                                ),  # objects in artifact S3 bucket
-                                Join(
-                                    "", ["arn:aws:s3:::", Ref(root_bucket_name_param)]
-                                ),  # 'root' S3 bucket
-                                Join(
-                                    "",
-                                    [
-                                        "arn:aws:s3:::",
-                                        Ref(root_bucket_name_param),
-                                        "/*",
-                                    ],
-                                ),  # objects in 'root' S3 bucket
-                            ],
+                            "Action": CODEBUILD_S3_ACTIONS,
+                            "Resource": s3_resource_arns,
                         },
                         {
                             "Effect": "Allow",
-                            "Action": [
-                                "codestar-connections:UseConnection",
-                                "codebuild:BatchGetBuilds",
-                                "codebuild:StartBuild",
-                                "codebuild:StopBuild",
-                                "codebuild:ListBuilds",
-                            ],
+                            "Action": BUILD_ACTIONS,
                             "Resource": [
                                 github_app_connection_arn,
                             ],
@@ -157,58 +196,17 @@ codebuild_role = template.add_resource(
             )
         ],
     )
-)
-
-# Define buildspec file (configured for next.js)
-buildspec = """
-    version: 0.2
-    phases:
-        install:
-            commands:
-                - echo "Installing dependencies"
-                - npm install
-                
-        pre_build:
-            commands:
-                - echo "Checking for .env file"
-                - if [ -f .env ]; then export $(cat .env | xargs); else echo ".env file not found. Skipping."; fi
-                - echo "Checking for .env.local file"
-                - if [ -f .env.local ]; then export $(cat .env.local | xargs); else echo ".env.local file not found. Skipping."; fi
-                
-        build:
-            commands:
-                - echo "Creating production build"
-                - npm run build
 
-        post_build:
-            commands:
-                - echo "Syncing build artifacts with S3"
-                - aws s3 sync ./out s3://$ROOT_BUCKET_NAME --delete
-                - echo "Invalidating CloudFront cache"
-                - aws cloudfront create-invalidation --distribution-id $DISTRIBUTION_ID --paths "/*"
-                
-    artifacts:
-        files:
-            - "**/*"
-        base-directory: out
-
-    cache:
-        paths:
-            - "node_modules/**/*" # Cache `node_modules` for faster `yarn` or `npm i`
-            - ".next/cache/**/*" # Cache Next.js for faster application rebuilds
-"""
-
-# Create CodeBuild Project
-codebuild_project = template.add_resource(
-    codebuild.Project(
+    # Create CodeBuild Project
+    codebuild_project = codebuild.Project(
         "CodeBuildGitHubPortfolio",
         Name=f"Build-GitHubPortfolio-{sanitized_domain}",
         Source=codebuild.Source(
             Type="GITHUB",
-            Location=f"https://github.com/{github_user_name}/{github_repo_name}",
+            Location=repo_url,
             GitCloneDepth=1,
             ReportBuildStatus=True,
-            BuildSpec=buildspec,
+            BuildSpec=BUILDSPEC,
         ),
         Environment=codebuild.Environment(
             ComputeType="BUILD_GENERAL1_SMALL",
@@ -222,11 +220,9 @@ codebuild_project = template.add_resource(
         ServiceRole=Ref(codebuild_role),
         Artifacts=codebuild.Artifacts(Type="NO_ARTIFACTS"),
     )
-)
 
-# Define IAM Role for CodePipeline with necessary permissions for starting CodeBuild builds
-codepipeline_role = template.add_resource(
-    iam.Role(
+    # Define IAM Role for CodePipeline with necessary permissions for starting CodeBuild builds
+    codepipeline_role = iam.Role(
         "CodePipelineServiceRole",
         AssumeRolePolicyDocument={
             "Version": "2012-10-17",
@@ -259,43 +255,12 @@ codepipeline_role = template.add_resource(
                         },
                         {
                             "Effect": "Allow",
-                            "Action": [
-                                "s3:GetObject",
-                                "s3:PutObject",
-                                "s3:PutObjectAcl",
-                                "s3:PutObjectVersionAcl",
-                                "s3:GetBucketLocation",
-                                "s3:ListBucket",
-                            ],
-                            "Resource": [
-                                Join(
-                                    "", ["arn:aws:s3:::", Ref(artifact_bucket)]
-                                ),  # artifact S3 bucket
-                                Join(
-                                    "", ["arn:aws:s3:::", Ref(artifact_bucket), "/*"]
-                                ),  # Objects in artifact S3 bucket
-                                Join(
-                                    "", ["arn:aws:s3:::", Ref(root_bucket_name_param)]
-                                ),  # 'root' S3 bucket
-                                Join(
-                                    "",
-                                    [
-                                        "arn:aws:s3:::",
-                                        Ref(root_bucket_name_param),
-                                        "/*",
-                                    ],  # Objects in 'root' S3 bucket
-                                ),
-                            ],
+                            "Action": CODEPIPELINE_S3_ACTIONS,
+                            "Resource": s3_resource_arns,
                         },
                         {
                             "Effect": "Allow",
-                            "Action": [
-                                "codestar-connections:UseConnection",
-                                "codebuild:BatchGetBuilds",
-                                "codebuild:StartBuild",
-                                "codebuild:StopBuild",
-                                "codebuild:ListBuilds",
-                            ],
+                            "Action": BUILD_ACTIONS,
                             "Resource": [
                                 GetAtt(codebuild_project, "Arn"),
                                 github_app_connection_arn,
@@ -306,11 +271,9 @@ codepipeline_role = template.add_resource(
             )
         ],
     )
-)
 
-# CodePipeline Setup
-pipeline = template.add_resource(
-    codepipeline.Pipeline(
+    # CodePipeline Setup
+    pipeline = codepipeline.Pipeline(
         "PipelineGitHubPortfolio",
         Name=f"Pipeline-GitHubPortfolio-{sanitized_domain}",
         RoleArn=GetAtt(codepipeline_role, "Arn"),
@@ -333,7 +296,7 @@ pipeline = template.add_resource(
                         ),
                         Configuration={
                             "ConnectionArn": github_app_connection_arn,
-                            "FullRepositoryId": f"{github_user_name}/{github_repo_name}",
+                            "FullRepositoryId": repo_id,
                             "BranchName": "main",
                         },
                         OutputArtifacts=[
@@ -389,10 +352,67 @@ pipeline = template.add_resource(
             ),
         ],
     )
-)
 
-# Export the CloudFormation template as YAML
-with open(f"cicd-pipeline-stack-{sanitized_domain}.yaml", "w") as f:
-    f.write(template.to_yaml())
+    # Add all parameters and resources to the template in one batch each
+    template.add_parameter([distribution_id_param, root_bucket_name_param])
+    template.add_resource(
+        [
+            artifact_bucket,
+            codebuild_role,
+            codebuild_project,
+            codepipeline_role,
+            pipeline,
+        ]
+    )
+
+    return template
+
+
+# Generate the CI/CD pipeline template from the values in .env
+def main():
+    # Load environment variables from .env, stopping early if any are missing or empty
+    domain_name, github_user_name, github_repo_name, github_app_connection_arn = (
+        require_env(
+            "DOMAIN_NAME",
+            "GITHUB_USER_NAME",
+            "GITHUB_REPO_NAME",
+            "GITHUB_APP_CONNECTION_ARN",
+        )
+    )
+
+    # Build and validate the template without writing it when DRY_RUN is set
+    if dry_run():
+        build_template(
+            domain_name, github_user_name, github_repo_name, github_app_connection_arn
+        ).to_dict()
+        print("Dry run: CI/CD pipeline template is valid.")
+        return
+
+    # Output file for the generated template
+    sanitized_domain = domain_name.translate(SANITIZE_TABLE)
+    output_file = f"cicd-pipeline-stack-{sanitized_domain}.json"
+
+    # Skip regeneration if the inputs haven't changed since the last run
+    stamp_key = template_key(
+        __file__,
+        domain_name,
+        github_user_name,
+        github_repo_name,
+        github_app_connection_arn,
+    )
+    if is_up_to_date(output_file, stamp_key):
+        print(f"CloudFormation template is up to date: {output_file}")
+        return
+
+    # Export the CloudFormation template as JSON
+    template = build_template(
+        domain_name, github_user_name, github_repo_name, github_app_connection_arn
+    )
+    write_template(template.to_dict(), output_file)
+    write_stamp(output_file, stamp_key)
+
+    print(f"Generated CloudFormation template: {output_file}")
+
 
-print(f"Generated CloudFormation template: cicd-pipeline-stack-{sanitized_domain}.yaml")
+if __name__ == "__main__":
+    main()
@@ -1,244 +1,433 @@
-import boto3
+import os
 import time
+import random
 import argparse
-import os
-from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from env_cache import require_env
 
 # Load domain name from .env
-load_dotenv()
-domain_name = os.getenv("DOMAIN_NAME")
+domain_name = require_env("DOMAIN_NAME")
 
-# Sanitize domain name
-sanitized_domain = domain_name.replace(".", "-").replace("/", "-")
+# Sanitize domain name in a single pass
+SANITIZE_TABLE = str.maketrans({".": "-", "/": "-"})
+sanitized_domain = domain_name.translate(SANITIZE_TABLE)
 
 # Stack names and template files
 ACM_STACK_NAME = f"acm-certificate-stack-{sanitized_domain}"
-ACM_TEMPLATE_FILE = f"acm-certificate-stack-{sanitized_domain}.yaml"
+ACM_TEMPLATE_FILE = f"acm-certificate-stack-{sanitized_domain}.json"
 MAIN_STACK_NAME = f"portfolio-website-stack-{sanitized_domain}"
-MAIN_TEMPLATE_FILE = f"portfolio-website-stack-{sanitized_domain}.yaml"
+MAIN_TEMPLATE_FILE = f"portfolio-website-stack-{sanitized_domain}.json"
 CICD_STACK_NAME = f"cicd-pipeline-stack-{sanitized_domain}"
-CICD_TEMPLATE_FILE = f"cicd-pipeline-stack-{sanitized_domain}.yaml"
-
-# List of valid AWS regions (as of 11/2024)
-VALID_AWS_REGIONS = [
-    "us-east-1",
-    "us-east-2",
-    "us-west-1",
-    "us-west-2",
-    "af-south-1",
-    "ap-east-1",
-    "ap-south-1",
-    "ap-northeast-1",
-    "ap-northeast-2",
-    "ap-northeast-3",
-    "ap-southeast-1",
-    "ap-southeast-2",
-    "ca-central-1",
-    "cn-north-1",
-    "cn-northwest-1",
-    "eu-central-1",
-    "eu-west-1",
-    "eu-west-2",
-    "eu-west-3",
-    "eu-north-1",
-    "eu-south-1",
-    "me-south-1",
-    "sa-east-1",
-]
+CICD_TEMPLATE_FILE = f"cicd-pipeline-stack-{sanitized_domain}.json"
+
+# Set of valid AWS regions (as of 11/2024)
+VALID_AWS_REGIONS = frozenset(
+    {
+        "us-east-1",
+        "us-east-2",
+        "us-west-1",
+        "us-west-2",
+        "af-south-1",
+        "ap-east-1",
+        "ap-south-1",
+        "ap-northeast-1",
+        "ap-northeast-2",
+        "ap-northeast-3",
+        "ap-southeast-1",
+        "ap-southeast-2",
+        "ca-central-1",
+        "cn-north-1",
+        "cn-northwest-1",
+        "eu-central-1",
+        "eu-west-1",
+        "eu-west-2",
+        "eu-west-3",
+        "eu-north-1",
+        "eu-south-1",
+        "me-south-1",
+        "sa-east-1",
+    }
+)
+
+# Deployment stages, in dependency order
+STAGE_NAMES = ["acm", "main", "cicd"]
 
 # Regions
 ACM_REGION = "us-east-1"  # Required region for ACM certificate
 MAIN_REGION = "us-west-2"  # Default region for the main stacks
 
-# Parse command-line arguments for --region argument (default to MAIN_REGION)
+# Stack statuses that can't be updated, so the stack is deleted and created again
+# (REVIEW_IN_PROGRESS is a stack left behind by a create change set that was never executed)
+RECREATE_STACK_STATUSES = frozenset(
+    {"ROLLBACK_COMPLETE", "DELETE_FAILED", "REVIEW_IN_PROGRESS"}
+)
+
+# Waiter polling settings (CloudFront stacks can take well over 10 minutes)
+WAITER_DELAY_RANGE = (8, 15)
+WAITER_MAX_ATTEMPTS = 240
+
+# Change sets are usually ready within seconds, so poll them much more often
+CHANGE_SET_WAITER_CONFIG = {"Delay": 5, "MaxAttempts": 60}
+
+# Main stack outputs holding the CloudFront distribution IDs
+DISTRIBUTION_OUTPUTS = ["DistributionId", "RedirectDistributionId"]
+
+# Templates larger than this are uploaded to S3 and passed by URL
+# (CloudFormation rejects inline template bodies over 51,200 bytes)
+TEMPLATE_BODY_MAX_SIZE = 40_000
+
+# Client settings: adaptive retries back off on throttling instead of failing the deploy
+BOTO_CONFIG = {
+    "retries": {"max_attempts": 10, "mode": "adaptive"},
+    "connect_timeout": 5,
+    "read_timeout": 30,
+}
+
+
+# Parse a comma-separated --stages argument into a list of stage names
+def parse_stages(value):
+    stages = [stage.strip() for stage in value.split(",") if stage.strip()]
+    if not stages:
+        raise argparse.ArgumentTypeError(
+            f"no stage given (choose from {', '.join(STAGE_NAMES)})"
+        )
+    for stage in stages:
+        if stage not in STAGE_NAMES:
+            raise argparse.ArgumentTypeError(
+                f"invalid stage: {stage} (choose from {', '.join(STAGE_NAMES)})"
+            )
+    return stages
+
+
+# Parse a comma-separated --invalidate argument into a list of paths
+def parse_paths(value):
+    return [path.strip() for path in value.split(",") if path.strip()]
+
+
+# Parse command-line arguments for --region argument (default to MAIN_REGION) and --stages argument
 parser = argparse.ArgumentParser(
     description="Deploy a CloudFormation stack.",
 )
 parser.add_argument(
     "--region",
     default=MAIN_REGION,
-    choices=VALID_AWS_REGIONS,
+    choices=sorted(VALID_AWS_REGIONS),
     help=f"The AWS region to deploy the main stack in (default: {MAIN_REGION})",
 )
+parser.add_argument(
+    "--stages",
+    default=STAGE_NAMES,
+    type=parse_stages,
+    help=f"Comma-separated stacks to deploy (default: {','.join(STAGE_NAMES)})",
+)
+parser.add_argument(
+    "--template-bucket",
+    help="S3 bucket to upload templates too large to send inline (in the main stack region)",
+)
+parser.add_argument(
+    "--invalidate",
+    metavar="PATHS",
+    type=parse_paths,
+    help="Comma-separated paths to invalidate on the CloudFront distributions after deploying (e.g., /*)",
+)
 args = parser.parse_args()
 
 MAIN_REGION = args.region  # overrides default region if user provides --region argument
+CICD_REGION = MAIN_REGION  # same region as main, so both stages share one client
 
-# Initialize the CloudFormation clients
-cf_client_acm = boto3.client("cloudformation", region_name=ACM_REGION)
-cf_client_main = boto3.client("cloudformation", region_name=MAIN_REGION)
-cf_client_cicd = boto3.client("cloudformation", region_name=MAIN_REGION)
 
+# Get the client for a service and region, created on first use and shared afterwards
+@lru_cache(maxsize=None)
+def get_client(region, service="cloudformation"):
+    # boto3 is only imported once a client is actually needed (not for --help)
+    import boto3
+    from botocore.config import Config
 
-# Load a template file
+    return boto3.client(service, region_name=region, config=Config(**BOTO_CONFIG))
+
+
+# Load a template file as the create/update arguments: TemplateBody, or TemplateURL if it's too large
 def load_template(template_file):
+    if args.template_bucket and os.path.getsize(template_file) > TEMPLATE_BODY_MAX_SIZE:
+        # Runs on a worker thread, so use a dedicated session rather than the shared default one
+        import boto3
+        from botocore.config import Config
+
+        key = os.path.basename(template_file)
+        s3_client = boto3.session.Session().client("s3", config=Config(**BOTO_CONFIG))
+        s3_client.upload_file(template_file, args.template_bucket, key)
+        return {"TemplateURL": f"https://{args.template_bucket}.s3.amazonaws.com/{key}"}
+
     with open(template_file, "r") as f:
-        return f.read()
+        return {"TemplateBody": f.read()}
 
 
-# Deploy a stack with the given client, name, and template
-def deploy_stack(client, stack_name, template_body, parameters=[], region=""):
+# Check if a stack exists (describe_stack_resources is throttled far less than describe_stacks)
+def stack_exists(client, stack_name):
     try:
-        # Check if stack exists and its status
-        response = client.describe_stacks(StackName=stack_name)
-        stack_status = response["Stacks"][0]["StackStatus"]
-
-        # If the stack is in a failed or rollback state, delete it before re-creating
-        if stack_status in ["ROLLBACK_COMPLETE", "DELETE_FAILED"]:
-            print(
-                f"Stack {stack_name} has status: {stack_status}. Deleting it for a fresh deployment."
-            )
-            client.delete_stack(StackName=stack_name)
-            wait_for_stack_deletion(client, stack_name)
+        client.describe_stack_resources(StackName=stack_name)
+        return True
+    except client.exceptions.ClientError as e:
+        error = e.response["Error"]
+        if error["Code"] == "ValidationError" and "does not exist" in error["Message"]:
+            return False
+        raise e
+
+
+# Get the stack's status if it's in a failed or rollback state, using a single filtered listing
+def get_failed_stack_status(client, stack_name):
+    paginator = client.get_paginator("list_stacks")
+    for page in paginator.paginate(StackStatusFilter=sorted(RECREATE_STACK_STATUSES)):
+        for stack in page["StackSummaries"]:
+            if stack["StackName"] == stack_name:
+                return stack["StackStatus"]
+    return None
+
+
+# Deploy a stack with the given client, name, and template arguments from load_template()
+def deploy_stack(client, stack_name, template, parameters=[], region=""):
+    from botocore.exceptions import WaiterError
+
+    # If the stack is in a failed or rollback state, delete it before re-creating
+    stack_status = get_failed_stack_status(client, stack_name)
+    if stack_status:
+        print(
+            f"Stack {stack_name} has status: {stack_status}. Deleting it for a fresh deployment."
+        )
+        client.delete_stack(StackName=stack_name)
+        wait_for_stack_deletion(client, stack_name)
+        stack_found = False
+    else:
+        stack_found = stack_exists(client, stack_name)
+
+    # Stage the deployment as a change set, which reports up front whether anything changed
+    if stack_found:
+        print(f"Stack {stack_name} exists. Creating a change set to update it.")
+        change_set_type = "UPDATE"
+    else:
+        print(f"Stack {stack_name} does not exist. Creating a new stack.")
+        change_set_type = "CREATE"
 
-        # If stack exists and is in a valid state, proceed with an update
-        client.update_stack(
+    try:
+        change_set_id = client.create_change_set(
             StackName=stack_name,
-            TemplateBody=template_body,
+            ChangeSetName=f"{stack_name}-{int(time.time())}",
+            ChangeSetType=change_set_type,
+            **template,
             Parameters=parameters,
             Capabilities=["CAPABILITY_NAMED_IAM"],
+        )["Id"]
+    except client.exceptions.ClientError as e:
+        # Some endpoints reject an unchanged template up front instead of failing the change set
+        error = e.response["Error"]
+        if (
+            error["Code"] == "ValidationError"
+            and "No updates are to be performed" in error["Message"]
+        ):
+            print(f"No updates to be performed for {stack_name} in region {region}.")
+            return describe_stack(client, stack_name)
+        raise e
+
+    try:
+        client.get_waiter("change_set_create_complete").wait(
+            ChangeSetName=change_set_id, WaiterConfig=CHANGE_SET_WAITER_CONFIG
         )
+    except WaiterError:
+        # An empty change set ends up FAILED; discard it and keep the stack as it is
+        change_set = client.describe_change_set(ChangeSetName=change_set_id)
+        reason = change_set.get("StatusReason", "")
+        if "didn't contain changes" in reason or "No updates" in reason:
+            client.delete_change_set(ChangeSetName=change_set_id)
+            print(f"No updates to be performed for {stack_name} in region {region}.")
+            return describe_stack(client, stack_name)
+        print(f"Error: Change set for {stack_name} failed: {reason}")
+        return describe_stack(client, stack_name)
+
+    client.execute_change_set(ChangeSetName=change_set_id)
+    if stack_found:
         print(f"Stack {stack_name} update initiated in region {region}.")
+        waiter_name = "stack_update_complete"
+    else:
+        print(f"Stack {stack_name} creation initiated in region {region}.")
+        waiter_name = "stack_create_complete"
 
-    except client.exceptions.ClientError as e:
-        # Creates new stack if it doesn't exist
-        if "does not exist" in str(e):
-            print(f"Stack {stack_name} does not exist. Creating a new stack.")
-            client.create_stack(
-                StackName=stack_name,
-                TemplateBody=template_body,
-                Parameters=parameters,
-                Capabilities=["CAPABILITY_NAMED_IAM"],
-            )
-            print(f"Stack {stack_name} creation initiated in region {region}.")
-        elif "No updates are to be performed" in str(e):
-            print(f"No updates to be performed for {stack_name} in region {region}.")
-        else:
-            raise e
-
-    wait_for_stack(client, stack_name)
-
-
-# Monitor stack operation status
-def wait_for_stack(client, stack_name):
-    while True:
-        try:
-            response = client.describe_stacks(StackName=stack_name)
-            stack_status = response["Stacks"][0]["StackStatus"]
-            print(f"Current stack status of {stack_name}: {stack_status}")
-
-            if stack_status in [
-                "CREATE_COMPLETE",
-                "UPDATE_COMPLETE",
-                "DELETE_COMPLETE",
-            ]:
-                print(f"Stack {stack_name} operation successful.")
-                break
-            elif stack_status.endswith("FAILED"):
-                print(
-                    f"Stack {stack_name} operation failed with status: {stack_status}"
-                )
-                break
-            elif stack_status == "ROLLBACK_COMPLETE":
-                print(f"Stack {stack_name} rolled back successfully.")
-                break
-        except client.exceptions.ClientError as e:
-            if "does not exist" in str(e):
-                print(f"Stack {stack_name} successfully deleted.")
-                break
-            else:
-                raise e
+    return wait_for_stack(client, stack_name, waiter_name)
 
-        time.sleep(10)
 
+# Get the current description of a stack
+def describe_stack(client, stack_name):
+    return client.describe_stacks(StackName=stack_name)["Stacks"][0]
 
-# Delete stack
-def wait_for_stack_deletion(client, stack_name):
-    while True:
-        try:
-            client.describe_stacks(StackName=stack_name)
-            print(f"Waiting for {stack_name} deletion to complete...")
-            time.sleep(10)
-        except client.exceptions.ClientError as e:
-            if "does not exist" in str(e):
-                print(f"Stack {stack_name} successfully deleted.")
-                break
-            else:
-                raise e
 
+# Get waiter settings with a fresh random delay, so parallel deployments don't poll in lockstep
+def waiter_config():
+    return {
+        "Delay": random.randint(*WAITER_DELAY_RANGE),
+        "MaxAttempts": WAITER_MAX_ATTEMPTS,
+    }
 
-# Main deployment flow
-def main():
-    # Step 1: Deploy the ACM stack in us-east-1
-    acm_template_body = load_template(ACM_TEMPLATE_FILE)
-    deploy_stack(cf_client_acm, ACM_STACK_NAME, acm_template_body, region=ACM_REGION)
 
-    # Step 2: Retrieve the CertificateArn after ACM stack deployment
+# Monitor stack operation status with the given boto3 waiter and return the final stack
+def wait_for_stack(client, stack_name, waiter_name):
+    from botocore.exceptions import WaiterError
+
+    print(f"Waiting for {stack_name} operation to complete...")
     try:
-        certificate_arn = cf_client_acm.describe_stacks(StackName=ACM_STACK_NAME)[
-            "Stacks"
-        ][0]["Outputs"][0]["OutputValue"]
-        print(f"Retrieved Certificate ARN: {certificate_arn}")
-    except (IndexError, KeyError):
-        print("Error: Could not retrieve CertificateArn from ACM stack.")
-        return
-
-    # Step 3: Deploy the main stack in specified region with the ACM certificate ARN
-    main_template_body = load_template(MAIN_TEMPLATE_FILE)
-    deploy_stack(
-        cf_client_main,
-        MAIN_STACK_NAME,
-        main_template_body,
-        parameters=[
-            {"ParameterKey": "CertificateArn", "ParameterValue": certificate_arn},
-            {"ParameterKey": "DeploymentRegion", "ParameterValue": MAIN_REGION},
-        ],
-        region=MAIN_REGION,
+        client.get_waiter(waiter_name).wait(
+            StackName=stack_name, WaiterConfig=waiter_config()
+        )
+        print(f"Stack {stack_name} operation successful.")
+        return describe_stack(client, stack_name)
+    except WaiterError as e:
+        stack = e.last_response.get("Stacks", [{}])[0]
+        stack_status = stack.get("StackStatus", "UNKNOWN")
+        print(f"Stack {stack_name} operation failed with status: {stack_status}")
+        return stack
+
+
+# Delete stack
+def wait_for_stack_deletion(client, stack_name):
+    print(f"Waiting for {stack_name} deletion to complete...")
+    client.get_waiter("stack_delete_complete").wait(
+        StackName=stack_name, WaiterConfig=waiter_config()
     )
+    print(f"Stack {stack_name} successfully deleted.")
 
-    # Step 4: Retrieve the Distribution ID and RootBucketName after main stack deployment
-    try:
-        stack_outputs = cf_client_main.describe_stacks(StackName=MAIN_STACK_NAME)[
-            "Stacks"
-        ][0]["Outputs"]
-
-        # Initialize variables
-        distribution_id = None
-        root_bucket_name = None
-
-        # Loop through outputs to find the specific values
-        for output in stack_outputs:
-            if output["OutputKey"] == "DistributionId":
-                distribution_id = output["OutputValue"]
-                print(f"Retrieved CloudFront Distribution ID: {distribution_id}")
-            elif output["OutputKey"] == "RootBucketName":
-                root_bucket_name = output["OutputValue"]
-                print(f"Retrieved Root S3 Bucket Name: {root_bucket_name}")
-
-        # Check if values were found
-        if not distribution_id:
-            print("Error: Could not retrieve Distribution ID from main stack.")
-            return
-        if not root_bucket_name:
-            print("Error: Could not retrieve Root S3 Bucket Name from main stack.")
-            return
 
-    except (IndexError, KeyError) as e:
-        print(f"Error: Could not retrieve outputs from main stack. Details: {e}")
-        return
+# Invalidate all paths on a distribution with a single batched invalidation
+def invalidate_distribution(client, distribution_id, paths):
+    client.create_invalidation(
+        DistributionId=distribution_id,
+        InvalidationBatch={
+            "Paths": {"Quantity": len(paths), "Items": paths},
+            "CallerReference": f"{distribution_id}-{time.time_ns()}",
+        },
+    )
+    print(
+        f"Invalidation of {', '.join(paths)} created for distribution {distribution_id}."
+    )
+
 
-    # Step 5: Deploy the CI/CD pipeline stack with the retrieved Distribution ID
-    cicd_template_body = load_template(CICD_TEMPLATE_FILE)
-    deploy_stack(
-        cf_client_cicd,
+# Invalidate the same paths on several distributions in parallel
+def invalidate_distributions(distribution_ids, paths):
+    # CloudFront is a global service; its API is served from us-east-1
+    client = get_client("us-east-1", "cloudfront")
+    with ThreadPoolExecutor(max_workers=len(distribution_ids)) as executor:
+        futures = [
+            executor.submit(invalidate_distribution, client, distribution_id, paths)
+            for distribution_id in distribution_ids
+        ]
+        for future in futures:
+            future.result()
+
+
+# Build the main stack parameters from the ACM stack outputs
+def main_stack_parameters(outputs):
+    return [
+        {"ParameterKey": "CertificateArn", "ParameterValue": outputs["CertificateArn"]},
+        {"ParameterKey": "DeploymentRegion", "ParameterValue": MAIN_REGION},
+    ]
+
+
+# Build the CI/CD stack parameters from the main stack outputs
+def cicd_stack_parameters(outputs):
+    return [
+        {"ParameterKey": "DistributionId", "ParameterValue": outputs["DistributionId"]},
+        {"ParameterKey": "RootBucketName", "ParameterValue": outputs["RootBucketName"]},
+    ]
+
+
+# Stage definitions: (stage, stack name, template file, region, parameter builder)
+# Each stage's parameters are built from the outputs of the stage before it
+STAGES = [
+    (
+        "acm",
+        ACM_STACK_NAME,
+        ACM_TEMPLATE_FILE,
+        ACM_REGION,
+        lambda outputs: [],
+    ),
+    (
+        "main",
+        MAIN_STACK_NAME,
+        MAIN_TEMPLATE_FILE,
+        MAIN_REGION,
+        main_stack_parameters,
+    ),
+    (
+        "cicd",
         CICD_STACK_NAME,
-        cicd_template_body,
-        parameters=[
-            {"ParameterKey": "DistributionId", "ParameterValue": distribution_id},
-            {"ParameterKey": "RootBucketName", "ParameterValue": root_bucket_name},
-        ],
-        region=MAIN_REGION,
-    )
+        CICD_TEMPLATE_FILE,
+        CICD_REGION,
+        cicd_stack_parameters,
+    ),
+]
+
+
+# Main deployment flow
+def main():
+    # Stop after the last requested stage; earlier stages only supply their outputs
+    last_stage = max(STAGE_NAMES.index(stage) for stage in args.stages)
+    stages = STAGES[: last_stage + 1]
+
+    # Read requested templates in the background so file I/O overlaps with the deployments
+    executor = ThreadPoolExecutor(max_workers=len(args.stages))
+    templates = {
+        stage: executor.submit(load_template, template_file)
+        for stage, _, template_file, _, _ in stages
+        if stage in args.stages
+    }
+    executor.shutdown(wait=False)
+
+    # Outputs of every stack so far, used to build later stacks' parameters
+    outputs = {}
+
+    for index, (stage, stack_name, _, region, build_parameters) in enumerate(stages):
+        client = get_client(region)
+
+        if stage in args.stages:
+            try:
+                parameters = build_parameters(outputs)
+            except KeyError as e:
+                print(f"Error: Could not retrieve {e} for the {stage} stack.")
+                return
+
+            stack = deploy_stack(
+                client,
+                stack_name,
+                templates[stage].result(),
+                parameters=parameters,
+                region=region,
+            )
+        elif STAGE_NAMES[index + 1] in args.stages:
+            # A skipped stage feeding the next requested stage must already be deployed
+            try:
+                stack = describe_stack(client, stack_name)
+            except client.exceptions.ClientError as e:
+                print(
+                    f"Error: Could not retrieve outputs from {stack_name}. Details: {e}"
+                )
+                return
+        else:
+            continue
+
+        # Collect the stack's outputs for the stage that depends on it
+        for output in stack.get("Outputs", []):
+            outputs[output["OutputKey"]] = output["OutputValue"]
+            print(f"Retrieved {output['OutputKey']}: {output['OutputValue']}")
+
+    # Clear cached content on the site's distributions once everything is deployed
+    if args.invalidate:
+        distribution_ids = [
+            outputs[key] for key in DISTRIBUTION_OUTPUTS if key in outputs
+        ]
+        if not distribution_ids:
+            print(
+                "Error: No distributions to invalidate (the main stack was not deployed)."
+            )
+            return
+        invalidate_distributions(distribution_ids, args.invalidate)
 
 
 if __name__ == "__main__":
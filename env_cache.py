@@ -0,0 +1,27 @@
+import os
+import sys
+from operator import itemgetter
+from dotenv import dotenv_values
+
+# Path to the .env file next to these scripts
+ENV_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".env")
+
+# Parsed environment, populated on first use
+_ENV = None
+
+
+# Parse .env once and return the cached values (real environment variables take precedence)
+def get_env():
+    global _ENV
+    if _ENV is None:
+        _ENV = {**dotenv_values(ENV_FILE), **os.environ}
+    return _ENV
+
+
+# Get required values (a single value for one key), stopping early if any are missing or empty
+def require_env(*keys):
+    env = get_env()
+    missing = [key for key in keys if not env.get(key)]
+    if missing:
+        sys.exit(f"Error: Missing required values in .env: {', '.join(missing)}")
+    return itemgetter(*keys)(env)
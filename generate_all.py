@@ -0,0 +1,25 @@
+from concurrent.futures import ProcessPoolExecutor
+import acm_certificate_template
+import cicd_pipeline_template
+import portfolio_website_template
+
+# Independent template generators, run in parallel
+GENERATORS = [
+    acm_certificate_template.main,
+    portfolio_website_template.main,
+    cicd_pipeline_template.main,
+]
+
+
+# Generate all templates, one worker process per generator
+def main():
+    with ProcessPoolExecutor(max_workers=len(GENERATORS)) as executor:
+        futures = [executor.submit(generator) for generator in GENERATORS]
+
+        # Surface any generator failure
+        for future in futures:
+            future.result()
+
+
+if __name__ == "__main__":
+    main()
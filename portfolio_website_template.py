@@ -1,211 +1,195 @@
-import os
-from dotenv import load_dotenv
-from troposphere import (
-    Template,
-    Ref,
-    Sub,
-    Parameter,
-    Output,
-    Export,
-    GetAtt,
-    s3,
-    cloudfront,
-    route53,
+import sys
+import argparse
+from env_cache import require_env
+from template_output import (
+    template_key,
+    dry_run,
+    dump_template,
+    is_up_to_date,
+    write_stamp,
+    write_template,
 )
 
-# Load environment variables from .env
-load_dotenv()
-domain_name = os.getenv("DOMAIN_NAME")
-hosted_zone_id = os.getenv("HOSTED_ZONE_ID")
+# Table for sanitizing domain names in a single pass
+SANITIZE_TABLE = str.maketrans({".": "-", "/": "-"})
 
-# Sanitize domain name
-sanitized_domain = domain_name.replace(".", "-").replace("/", "-")
 
-# Initialize the CloudFormation template
-template = Template()
-template.set_description(
-    "CloudFormation stack for hosting a portfolio website with S3, CloudFront, and Route53."
-)
+# Build a CloudFront distribution serving a single S3 website bucket over HTTPS
+def make_distribution(
+    title,
+    bucket_title,
+    origin_id,
+    origin_domain,
+    alias,
+    comment,
+    origin_config,
+    viewer_certificate,
+):
+    from troposphere import cloudfront
+
+    return cloudfront.Distribution(
+        title,
+        DependsOn=bucket_title,
+        DistributionConfig=cloudfront.DistributionConfig(
+            Origins=[
+                cloudfront.Origin(
+                    Id=origin_id,
+                    DomainName=origin_domain,
+                    CustomOriginConfig=origin_config,
+                )
+            ],
+            Enabled=True,
+            Comment=comment,
+            Aliases=[alias],
+            ViewerCertificate=viewer_certificate,
+            DefaultCacheBehavior=cloudfront.DefaultCacheBehavior(
+                TargetOriginId=origin_id,
+                ViewerProtocolPolicy="redirect-to-https",
+                AllowedMethods=["GET", "HEAD"],
+                CachedMethods=["GET", "HEAD"],
+                ForwardedValues=cloudfront.ForwardedValues(
+                    QueryString=False,
+                    Cookies=cloudfront.Cookies(Forward="none"),
+                ),
+                CachePolicyId="658327ea-f89d-4fab-a63d-7e88639e58f6",  # Managed-CachingOptimized
+            ),
+            PriceClass="PriceClass_All",
+            HttpVersion="http2and3",
+        ),
+    )
+
+
+# Build the portfolio website template for the given domain
+def build_template(domain_name, hosted_zone_id):
+    from troposphere import (
+        Template,
+        Ref,
+        Sub,
+        Parameter,
+        Output,
+        Export,
+        GetAtt,
+        s3,
+        cloudfront,
+        route53,
+    )
+
+    sanitized_domain = domain_name.translate(SANITIZE_TABLE)
+    www_domain = f"www.{domain_name}"
+    root_objects_arn = f"arn:aws:s3:::{domain_name}/*"
+
+    # Initialize the CloudFormation template
+    template = Template()
+    template.set_description(
+        "CloudFormation stack for hosting a portfolio website with S3, CloudFront, and Route53."
+    )
 
-# Add region as a parameter
-region_param = template.add_parameter(
-    Parameter(
+    # Add region as a parameter
+    region_param = Parameter(
         "DeploymentRegion",
         Type="String",
         Description="AWS region for deployment",
     )
-)
 
-# Retrieve the ACM certificate ARN as a parameter
-certificate_arn_param = template.add_parameter(
-    Parameter(
+    # Retrieve the ACM certificate ARN as a parameter
+    certificate_arn_param = Parameter(
         "CertificateArn",
         Type="String",
         Description="The ARN of the ACM certificate in us-east-1",
     )
-)
 
-# Define 'root' S3 bucket for website hosting
-root_bucket = template.add_resource(
-    s3.Bucket(
+    # Bucket settings shared by both S3 buckets
+    public_access_block = s3.PublicAccessBlockConfiguration(
+        BlockPublicAcls=False,
+        IgnorePublicAcls=False,
+        BlockPublicPolicy=False,
+        RestrictPublicBuckets=False,
+    )
+    versioning = s3.VersioningConfiguration(Status="Enabled")
+    bucket_encryption = s3.BucketEncryption(
+        ServerSideEncryptionConfiguration=[
+            s3.ServerSideEncryptionRule(
+                ServerSideEncryptionByDefault=s3.ServerSideEncryptionByDefault(
+                    SSEAlgorithm="AES256"
+                ),
+                BucketKeyEnabled=False,
+            )
+        ]
+    )
+
+    # Define 'root' S3 bucket for website hosting
+    root_bucket = s3.Bucket(
         "PortfolioRootBucket",
         BucketName=domain_name,
         WebsiteConfiguration=s3.WebsiteConfiguration(
             IndexDocument="index.html", ErrorDocument="404.html"
         ),
-        PublicAccessBlockConfiguration=s3.PublicAccessBlockConfiguration(
-            BlockPublicAcls=False,
-            IgnorePublicAcls=False,
-            BlockPublicPolicy=False,
-            RestrictPublicBuckets=False,
-        ),
-        VersioningConfiguration=s3.VersioningConfiguration(Status="Enabled"),
-        BucketEncryption=s3.BucketEncryption(
-            ServerSideEncryptionConfiguration=[
-                s3.ServerSideEncryptionRule(
-                    ServerSideEncryptionByDefault=s3.ServerSideEncryptionByDefault(
-                        SSEAlgorithm="AES256"
-                    ),
-                    BucketKeyEnabled=False,
-                )
-            ]
-        ),
+        PublicAccessBlockConfiguration=public_access_block,
+        VersioningConfiguration=versioning,
+        BucketEncryption=bucket_encryption,
     )
-)
+    # Shared by the bucket policy and the bucket name output
+    root_bucket_ref = Ref(root_bucket)
 
-
-# Define 'redirect' S3 bucket for www-redirect
-redirect_bucket = template.add_resource(
-    s3.Bucket(
+    # Define 'redirect' S3 bucket for www-redirect
+    redirect_bucket = s3.Bucket(
         "PortfolioRedirectBucket",
-        BucketName=f"www.{domain_name}",
+        BucketName=www_domain,
         WebsiteConfiguration=s3.WebsiteConfiguration(
             RedirectAllRequestsTo=s3.RedirectAllRequestsTo(
                 HostName=domain_name,
                 Protocol="http",
             )
         ),
-        PublicAccessBlockConfiguration=s3.PublicAccessBlockConfiguration(
-            BlockPublicAcls=False,
-            IgnorePublicAcls=False,
-            BlockPublicPolicy=False,
-            RestrictPublicBuckets=False,
-        ),
-        VersioningConfiguration=s3.VersioningConfiguration(Status="Enabled"),
-        BucketEncryption=s3.BucketEncryption(
-            ServerSideEncryptionConfiguration=[
-                s3.ServerSideEncryptionRule(
-                    ServerSideEncryptionByDefault=s3.ServerSideEncryptionByDefault(
-                        SSEAlgorithm="AES256"
-                    ),
-                    BucketKeyEnabled=False,
-                )
-            ]
-        ),
+        PublicAccessBlockConfiguration=public_access_block,
+        VersioningConfiguration=versioning,
+        BucketEncryption=bucket_encryption,
+    )
+
+    # Origin and certificate settings shared by both CloudFront distributions
+    http_only_origin = cloudfront.CustomOriginConfig(OriginProtocolPolicy="http-only")
+    viewer_certificate = cloudfront.ViewerCertificate(
+        AcmCertificateArn=Ref(certificate_arn_param),
+        SslSupportMethod="sni-only",
+        MinimumProtocolVersion="TLSv1.2_2021",
     )
-)
 
-# Define the 'root' CloudFront distribution
-root_distribution = template.add_resource(
-    cloudfront.Distribution(
+    # Define the 'root' CloudFront distribution
+    root_distribution = make_distribution(
         "PortfolioRootDistribution",
-        DependsOn="PortfolioRootBucket",  # Ensure the 'root' bucket is created
-        DistributionConfig=cloudfront.DistributionConfig(
-            Origins=[
-                cloudfront.Origin(
-                    Id=f"S3-Portfolio-Root-{sanitized_domain}",
-                    DomainName=Sub(
-                        "${DomainName}.s3-website-${DeploymentRegion}.amazonaws.com",
-                        {
-                            "DomainName": domain_name,
-                            "DeploymentRegion": Ref(region_param),
-                        },
-                    ),
-                    CustomOriginConfig=cloudfront.CustomOriginConfig(
-                        OriginProtocolPolicy="http-only"
-                    ),
-                )
-            ],
-            Enabled=True,
-            Comment=f"'Root' distribution ({domain_name})",
-            Aliases=[domain_name],
-            ViewerCertificate=cloudfront.ViewerCertificate(
-                AcmCertificateArn=Ref(certificate_arn_param),
-                SslSupportMethod="sni-only",
-                MinimumProtocolVersion="TLSv1.2_2021",
-            ),
-            DefaultCacheBehavior=cloudfront.DefaultCacheBehavior(
-                TargetOriginId=f"S3-Portfolio-Root-{sanitized_domain}",
-                ViewerProtocolPolicy="redirect-to-https",
-                AllowedMethods=["GET", "HEAD"],
-                CachedMethods=["GET", "HEAD"],
-                ForwardedValues=cloudfront.ForwardedValues(
-                    QueryString=False,
-                    Cookies=cloudfront.Cookies(Forward="none"),
-                ),
-                CachePolicyId="658327ea-f89d-4fab-a63d-7e88639e58f6",  # Managed-CachingOptimized
-            ),
-            PriceClass="PriceClass_All",
-            HttpVersion="http2and3",
+        bucket_title="PortfolioRootBucket",  # Ensure the 'root' bucket is created
+        origin_id=f"S3-Portfolio-Root-{sanitized_domain}",
+        origin_domain=Sub(
+            f"{domain_name}.s3-website-${{DeploymentRegion}}.amazonaws.com"
         ),
+        alias=domain_name,
+        comment=f"'Root' distribution ({domain_name})",
+        origin_config=http_only_origin,
+        viewer_certificate=viewer_certificate,
     )
-)
 
-# Define the 'redirect' CloudFront distribution
-redirect_distribution = template.add_resource(
-    cloudfront.Distribution(
+    # Define the 'redirect' CloudFront distribution
+    redirect_distribution = make_distribution(
         "PortfolioRedirectDistribution",
-        DependsOn="PortfolioRedirectBucket",  # Ensure the 'redirect' bucket is created
-        DistributionConfig=cloudfront.DistributionConfig(
-            Origins=[
-                cloudfront.Origin(
-                    Id=f"S3-Portfolio-Redirect-{sanitized_domain}",
-                    DomainName=Sub(
-                        "www.${DomainName}.s3-website-${DeploymentRegion}.amazonaws.com",
-                        {
-                            "DomainName": domain_name,
-                            "DeploymentRegion": Ref(region_param),
-                        },
-                    ),
-                    CustomOriginConfig=cloudfront.CustomOriginConfig(
-                        OriginProtocolPolicy="http-only"
-                    ),
-                )
-            ],
-            Enabled=True,
-            Comment=f"'Redirect' distribution (www.{domain_name})",
-            Aliases=[f"www.{domain_name}"],
-            ViewerCertificate=cloudfront.ViewerCertificate(
-                AcmCertificateArn=Ref(certificate_arn_param),
-                SslSupportMethod="sni-only",
-                MinimumProtocolVersion="TLSv1.2_2021",
-            ),
-            DefaultCacheBehavior=cloudfront.DefaultCacheBehavior(
-                TargetOriginId=f"S3-Portfolio-Redirect-{sanitized_domain}",
-                ViewerProtocolPolicy="redirect-to-https",
-                AllowedMethods=["GET", "HEAD"],
-                CachedMethods=["GET", "HEAD"],
-                ForwardedValues=cloudfront.ForwardedValues(
-                    QueryString=False,
-                    Cookies=cloudfront.Cookies(Forward="none"),
-                ),
-                CachePolicyId="658327ea-f89d-4fab-a63d-7e88639e58f6",  # Managed-CachingOptimized
-            ),
-            PriceClass="PriceClass_All",
-            HttpVersion="http2and3",
+        bucket_title="PortfolioRedirectBucket",  # Ensure the 'redirect' bucket is created
+        origin_id=f"S3-Portfolio-Redirect-{sanitized_domain}",
+        origin_domain=Sub(
+            f"{www_domain}.s3-website-${{DeploymentRegion}}.amazonaws.com"
         ),
+        alias=www_domain,
+        comment=f"'Redirect' distribution ({www_domain})",
+        origin_config=http_only_origin,
+        viewer_certificate=viewer_certificate,
     )
-)
 
-# Define root S3 bucket policy, using the DistributionId from CloudFront
-bucket_policy = template.add_resource(
-    s3.BucketPolicy(
+    # Define root S3 bucket policy, using the DistributionId from CloudFront
+    bucket_policy = s3.BucketPolicy(
         "PortfolioRootBucketPolicy",
         DependsOn=[
             "PortfolioRootBucket",
             "PortfolioRootDistribution",
         ],  # Ensure the 'root' bucket and 'root' distribution are created
-        Bucket=Ref(root_bucket),
+        Bucket=root_bucket_ref,
         PolicyDocument={
             "Version": "2012-10-17",
             "Statement": [
@@ -214,19 +198,18 @@ bucket_policy = template.add_resource(
                     "Effect": "Allow",
                     "Principal": "*",
                     "Action": "s3:GetObject",
-                    "Resource": f"arn:aws:s3:::{domain_name}/*",
+                    "Resource": root_objects_arn,
                 },
                 {
                     "Sid": f"CloudFrontDistributionReadAccess-{sanitized_domain}",
                     "Effect": "Allow",
                     "Principal": {"Service": "cloudfront.amazonaws.com"},
                     "Action": "s3:GetObject",
-                    "Resource": f"arn:aws:s3:::{domain_name}/*",
+                    "Resource": root_objects_arn,
                     "Condition": {
                         "StringEquals": {
                             "AWS:SourceArn": Sub(
-                                "arn:aws:cloudfront::${AWS::AccountId}:distribution/${DistributionId}",
-                                {"DistributionId": Ref(root_distribution)},
+                                "arn:aws:cloudfront::${AWS::AccountId}:distribution/${PortfolioRootDistribution}"
                             )
                         }
                     },
@@ -234,11 +217,9 @@ bucket_policy = template.add_resource(
             ],
         },
     )
-)
 
-# Route 53 A Record to point primary domain to the 'root' CloudFront distribution
-a_record_root = template.add_resource(
-    route53.RecordSetType(
+    # Route 53 A Record to point primary domain to the 'root' CloudFront distribution
+    a_record_root = route53.RecordSetType(
         "PortfolioRootDNSRecord",
         DependsOn="PortfolioRootDistribution",  # Ensure the 'root' distribution is created
         HostedZoneId=hosted_zone_id,
@@ -249,49 +230,117 @@ a_record_root = template.add_resource(
             HostedZoneId="Z2FDTNDATAQYW2",  # AWS Global CloudFront Hosted Zone ID (don't change this)
         ),
     )
-)
 
-# Route 53 A Record to point www-prefixed domain to the 'redirect' CloudFront distribution
-a_record_redirect = template.add_resource(
-    route53.RecordSetType(
+    # Route 53 A Record to point www-prefixed domain to the 'redirect' CloudFront distribution
+    a_record_redirect = route53.RecordSetType(
         "PortfolioRedirectDNSRecord",
         DependsOn="PortfolioRedirectDistribution",  # Ensure the 'redirect' distribution is created
         HostedZoneId=hosted_zone_id,
-        Name=f"www.{domain_name}",
+        Name=www_domain,
         Type="A",
         AliasTarget=route53.AliasTarget(
             DNSName=GetAtt(redirect_distribution, "DomainName"),
             HostedZoneId="Z2FDTNDATAQYW2",  # AWS Global CloudFront Hosted Zone ID (don't change this)
         ),
     )
-)
 
-# Output the 'root' CloudFront Distribution ID for cross-stack reference
-template.add_output(
-    Output(
+    # Output the 'root' CloudFront Distribution ID for cross-stack reference
+    distribution_id_output = Output(
         "DistributionId",
         Value=Ref(root_distribution),
         Export=Export(
             f"PortfolioDistributionID-{sanitized_domain}"
         ),  # Name for cross-stack export
     )
-)
 
-# Output the 'root' S3 Bucket name for cross-stack reference
-template.add_output(
-    Output(
+    # Output the 'redirect' CloudFront Distribution ID so its cache can be invalidated too
+    redirect_distribution_id_output = Output(
+        "RedirectDistributionId",
+        Value=Ref(redirect_distribution),
+        Export=Export(
+            f"PortfolioRedirectDistributionID-{sanitized_domain}"
+        ),  # Name for cross-stack export
+    )
+
+    # Output the 'root' S3 Bucket name for cross-stack reference
+    root_bucket_name_output = Output(
         "RootBucketName",
-        Value=Ref(root_bucket),
+        Value=root_bucket_ref,
         Export=Export(
             f"PortfolioRootBucketName-{sanitized_domain}"
         ),  # Name for cross-stack export
     )
-)
 
-# Export the CloudFormation template as YAML
-with open(f"portfolio-website-stack-{sanitized_domain}.yaml", "w") as f:
-    f.write(template.to_yaml())
+    # Add all parameters, resources, and outputs to the template in one batch each
+    template.add_parameter([region_param, certificate_arn_param])
+    template.add_resource(
+        [
+            root_bucket,
+            redirect_bucket,
+            root_distribution,
+            redirect_distribution,
+            bucket_policy,
+            a_record_root,
+            a_record_redirect,
+        ]
+    )
+    template.add_output(
+        [
+            distribution_id_output,
+            redirect_distribution_id_output,
+            root_bucket_name_output,
+        ]
+    )
 
-print(
-    f"Generated CloudFormation template: portfolio-website-stack-{sanitized_domain}.yaml"
-)
+    return template
+
+
+# Generate the portfolio website template from the values in .env
+def main():
+    # Parse command-line arguments for --stdout argument
+    parser = argparse.ArgumentParser(
+        description="Generate the portfolio website CloudFormation template.",
+    )
+    parser.add_argument(
+        "--stdout",
+        action="store_true",
+        help="Print the template to stdout instead of writing it to a file",
+    )
+    args = parser.parse_args()
+
+    # Load environment variables from .env, stopping early if any are missing or empty
+    domain_name, hosted_zone_id = require_env("DOMAIN_NAME", "HOSTED_ZONE_ID")
+
+    # Build and validate the template without writing it when DRY_RUN is set
+    if dry_run():
+        build_template(domain_name, hosted_zone_id).to_dict()
+        print("Dry run: portfolio website template is valid.")
+        return
+
+    # Print the template for piping into other tools, skipping the file and stamp entirely
+    if args.stdout:
+        sys.stdout.write(
+            dump_template(build_template(domain_name, hosted_zone_id).to_dict())
+        )
+        return
+
+    # Output file for the generated template
+    sanitized_domain = domain_name.translate(SANITIZE_TABLE)
+    output_file = f"portfolio-website-stack-{sanitized_domain}.json"
+
+    # Skip regeneration if the inputs haven't changed since the last run
+    stamp_key = template_key(__file__, domain_name, hosted_zone_id)
+    if is_up_to_date(output_file, stamp_key):
+        print(f"CloudFormation template is up to date: {output_file}")
+        return
+
+    # Write the template to a JSON file
+    template = build_template(domain_name, hosted_zone_id)
+    write_template(template.to_dict(), output_file)
+    write_stamp(output_file, stamp_key)
+
+    print(f"Generated CloudFormation template: {output_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import hashlib
+import importlib.util
+import json
+import os
+from env_cache import get_env
+
+
+# Build a cache key from the generator script, this module, troposphere, and the template inputs
+def template_key(script_file, *inputs):
+    source_files = [script_file, __file__]
+
+    # troposphere's __init__ sets its __version__, so hashing it catches upgrades without importing it
+    troposphere_spec = importlib.util.find_spec("troposphere")
+    if troposphere_spec:
+        source_files.append(troposphere_spec.origin)
+
+    digest = hashlib.blake2b()
+    for source_file in source_files:
+        with open(source_file, "rb") as f:
+            digest.update(f.read())
+    digest.update(repr((inputs, emit_yaml())).encode())
+    return digest.hexdigest()
+
+
+# Check if a YAML copy of the template was requested
+def emit_yaml():
+    return bool(get_env().get("EMIT_YAML"))
+
+
+# Check if templates should only be built and validated, without being written
+def dry_run():
+    return bool(get_env().get("DRY_RUN"))
+
+
+# Check if the output file was already generated with the same key
+def is_up_to_date(output_file, key):
+    if not os.path.exists(output_file):
+        return False
+    try:
+        with open(f"{output_file}.stamp", "r") as f:
+            return f.read() == key
+    except FileNotFoundError:
+        return False
+
+
+# Write a file atomically so a crash never leaves a truncated file behind
+def write_file(path, contents):
+    data = contents.encode("utf-8")
+    tmp_path = f"{path}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view) :]
+        # Flush to disk before the rename, or a power loss can still leave an empty file
+        os.fsync(fd)
+    except BaseException:
+        os.close(fd)
+        os.remove(tmp_path)
+        raise
+    os.close(fd)
+    os.replace(tmp_path, path)
+
+
+# Record the key the output file was generated with
+def write_stamp(output_file, key):
+    write_file(f"{output_file}.stamp", key)
+
+
+# Serialize the template dict as minified JSON
+def dump_template(template):
+    return json.dumps(template, sort_keys=True, separators=(",", ":"))
+
+
+# Write the template dict as minified JSON, plus a YAML copy for humans if EMIT_YAML is set
+def write_template(template, output_file):
+    template_json = dump_template(template)
+    write_file(output_file, template_json)
+
+    if emit_yaml():
+        import cfn_flip
+
+        yaml_file = f"{os.path.splitext(output_file)[0]}.yaml"
+        write_file(yaml_file, cfn_flip.to_yaml(template_json))